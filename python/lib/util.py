@@ -23,6 +23,10 @@ import os
 # External packages
 import json
 import yaml
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 
 # SCION
 from python.lib.errors import (
@@ -77,7 +81,7 @@ def load_yaml_file(file_path):
     """
     try:
         with open(file_path) as f:
-            return yaml.load(f, Loader=yaml.SafeLoader)
+            return yaml.load(f, Loader=SafeLoader)
     except OSError as e:
         raise SCIONIOError("Error opening '%s': %s" %
                            (file_path, e.strerror)) from None
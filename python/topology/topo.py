@@ -22,9 +22,14 @@ import logging
 import os
 import random
 from collections import defaultdict
+from functools import lru_cache
 
 # External packages
 import yaml
+try:
+    from yaml import CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeDumper
 
 # SCION
 from python.lib.defines import (
@@ -94,25 +99,33 @@ class TopoGenerator(object):
         self.virt_addrs = set()
         self.as_list = defaultdict(list)
         self.links = defaultdict(list)
-        self.ifid_map = {}
+        # Link addresses registered in the first pass, reused by _gen_br_entry.
+        self.link_addrs = {}
+        self.ifid_map = defaultdict(dict)
 
     def _reg_addr(self, topo_id: TopoID, elem_id, addr_type):
-        subnet = self.args.subnet_gen[addr_type].register(str(topo_id))
+        subnet_gen = self.args.subnet_gen
+        topo_str = str(topo_id)
+        subnet = subnet_gen[addr_type].register(topo_str)
         if self.args.docker and addr_type == ADDR_TYPE_6:
             # for docker also allocate an IPv4 address so that we have ipv4
             # range allocated for the network.
-            v4subnet = self.args.subnet_gen[ADDR_TYPE_4].register(str(topo_id) + '_v4')
+            v4subnet = subnet_gen[ADDR_TYPE_4].register(topo_str + '_v4')
             v4subnet.register(elem_id + '_v4')
         return subnet.register(elem_id)
 
     def _reg_link_addrs(self, local_br, remote_br, local_ifid, remote_ifid, addr_type):
-        link_name = str(sorted((local_br, remote_br)))
-        link_name += str(sorted((local_ifid, remote_ifid)))
-        subnet = self.args.subnet_gen[addr_type].register(link_name)
+        # Same name as str(sorted(brs)) + str(sorted(ifids)), which fixes the order in
+        # which SubnetGenerator allocates the link subnets.
+        link_name = "['%s', '%s'][%d, %d]" % (
+            min(local_br, remote_br), max(local_br, remote_br),
+            min(local_ifid, remote_ifid), max(local_ifid, remote_ifid))
+        subnet_gen = self.args.subnet_gen
+        subnet = subnet_gen[addr_type].register(link_name)
         if self.args.docker and addr_type == ADDR_TYPE_6:
             # for docker also allocate an IPv4 address so that we have ipv4
             # range allocated for the network.
-            v4subnet = self.args.subnet_gen[ADDR_TYPE_4].register(link_name + '_v4')
+            v4subnet = subnet_gen[ADDR_TYPE_4].register(link_name + '_v4')
             v4subnet.register(local_br + '_v4')
         return subnet.register(local_br), subnet.register(remote_br)
 
@@ -138,13 +151,14 @@ class TopoGenerator(object):
         return self.topo_dicts, networks
 
     def _register_addrs(self, topo_id, as_conf):
-        self._register_srv_entries(topo_id, as_conf)
-        self._register_br_entries(topo_id, as_conf)
+        addr_type = addr_type_from_underlay(as_conf.get('underlay', DEFAULT_UNDERLAY))
+        self._register_srv_entries(topo_id, as_conf, addr_type)
+        self._register_br_entries(topo_id, addr_type)
         if self.args.sig:
-            self._register_sig(topo_id, as_conf)
-        self._register_sciond(topo_id, as_conf)
+            self._register_sig(topo_id, addr_type)
+        self._register_sciond(topo_id, addr_type)
 
-    def _register_srv_entries(self, topo_id, as_conf):
+    def _register_srv_entries(self, topo_id, as_conf, addr_type):
         """ registers the addresses of all the services """
         srvs = [("control_servers", DEFAULT_CONTROL_SERVERS, "cs")]
         srvs.append(("colibri_servers", DEFAULT_COLIBRI_SERVERS, "co"))
@@ -154,19 +168,20 @@ class TopoGenerator(object):
         # thus the debug service does NOT exist (only entries in network, etc).
         srvs.append(("colibri_dbg_servers", DEFAULT_COLIBRI_SERVERS, "codbg"))
         for conf_key, def_num, nick in srvs:
-            self._register_srv_entry(topo_id, as_conf, conf_key, def_num, nick)
+            self._register_srv_entry(topo_id, as_conf, conf_key, def_num, nick, addr_type)
 
-    def _register_srv_entry(self, topo_id, as_conf, conf_key, def_num, nick):
-        addr_type = addr_type_from_underlay(as_conf.get('underlay', DEFAULT_UNDERLAY))
+    def _register_srv_entry(self, topo_id, as_conf, conf_key, def_num, nick, addr_type):
         count = self._srv_count(as_conf, conf_key, def_num)
+        file_fmt = topo_id.file_fmt()
+        docker = self.args.docker
+        port_gen = self.args.port_gen
         for i in range(1, count + 1):
-            elem_id = "%s%s-%s" % (nick, topo_id.file_fmt(), i)
-            if not self.args.docker:
-                self.args.port_gen.register(elem_id)
+            elem_id = "%s%s-%s" % (nick, file_fmt, i)
+            if not docker:
+                port_gen.register(elem_id)
             self._reg_addr(topo_id, elem_id, addr_type)
 
-    def _register_br_entries(self, topo_id, as_conf):
-        addr_type = addr_type_from_underlay(as_conf.get('underlay', DEFAULT_UNDERLAY))
+    def _register_br_entries(self, topo_id, addr_type):
         for (linkto, remote, attrs, l_br, r_br, l_ifid, r_ifid) in self.links[topo_id]:
             self._register_br_entry(topo_id, l_ifid, remote, r_ifid,
                                     linkto, attrs, l_br, r_br, addr_type)
@@ -174,22 +189,22 @@ class TopoGenerator(object):
     def _register_br_entry(self, local, l_ifid, remote, r_ifid, remote_type, attrs,
                            local_br, remote_br, addr_type):
         link_addr_type = addr_type_from_underlay(attrs.get('underlay', DEFAULT_UNDERLAY))
-        self._reg_link_addrs(local_br, remote_br, l_ifid, r_ifid, link_addr_type)
+        self.link_addrs[(local_br, remote_br, l_ifid, r_ifid)] = self._reg_link_addrs(
+            local_br, remote_br, l_ifid, r_ifid, link_addr_type)
         self._reg_addr(local, local_br + "_internal", addr_type)
         if not self.args.docker:
             self.args.port_gen.register(local_br + "_internal")
 
-    def _register_sig(self, topo_id, as_conf):
-        addr_type = addr_type_from_underlay(as_conf.get('underlay', DEFAULT_UNDERLAY))
+    def _register_sig(self, topo_id, addr_type):
         self._reg_addr(topo_id, "sig" + topo_id.file_fmt(), addr_type)
 
-    def _register_sciond(self, topo_id, as_conf):
-        addr_type = addr_type_from_underlay(as_conf.get('underlay', DEFAULT_UNDERLAY))
-        self._reg_addr(topo_id, "sd" + topo_id.file_fmt(), addr_type)
+    def _register_sciond(self, topo_id, addr_type):
+        file_fmt = topo_id.file_fmt()
+        self._reg_addr(topo_id, "sd" + file_fmt, addr_type)
         # Always register the tester element. This causes the generator to create a
         # bridge in the docker topology, which SCIOND, SIG (if enabled) and
         # client applications can use to communicate.
-        self._reg_addr(topo_id, "tester_" + topo_id.file_fmt(), addr_type)
+        self._reg_addr(topo_id, "tester_" + file_fmt, addr_type)
 
     def _br_name(self, ep, assigned_br_id, br_ids, if_ids):
         br_name = ep.br_name()
@@ -231,10 +246,10 @@ class TopoGenerator(object):
             self.links[b].append((linkto_a, a, attrs, b_br, a_br, b_ifid, a_ifid))
             a_desc = "%s %s" % (a_br, a_ifid)
             b_desc = "%s %s" % (b_br, b_ifid)
-            self.ifid_map.setdefault(str(a), {})
             self.ifid_map[str(a)][a_desc] = b_desc
-            self.ifid_map.setdefault(str(b), {})
             self.ifid_map[str(b)][b_desc] = a_desc
+        # The link lists are only iterated from here on.
+        self.links = defaultdict(tuple, ((k, tuple(v)) for k, v in self.links.items()))
 
     def _generate_as_topo(self, topo_id, as_conf):
         mtu = as_conf.get('mtu', self.args.default_mtu)
@@ -250,29 +265,32 @@ class TopoGenerator(object):
         }
         for i in SCION_SERVICE_NAMES:
             self.topo_dicts[topo_id][i] = {}
-        self._gen_srv_entries(topo_id, as_conf)
-        self._gen_br_entries(topo_id, as_conf)
+        addr_type = addr_type_from_underlay(as_conf.get('underlay', DEFAULT_UNDERLAY))
+        self._gen_srv_entries(topo_id, as_conf, addr_type)
+        self._gen_br_entries(topo_id, addr_type)
         if self.args.sig:
             self.topo_dicts[topo_id]['sigs'] = {}
             self._gen_sig_entries(topo_id, as_conf)
 
-    def _gen_srv_entries(self, topo_id, as_conf):
+    def _gen_srv_entries(self, topo_id, as_conf, addr_type):
         srvs = [("control_servers", DEFAULT_CONTROL_SERVERS, "cs", "control_service")]
         srvs.append(("control_servers", DEFAULT_CONTROL_SERVERS, "cs", "discovery_service"))
         srvs.append(("colibri_servers", DEFAULT_COLIBRI_SERVERS, "co", "colibri_service"))
         for conf_key, def_num, nick, topo_key in srvs:
-            self._gen_srv_entry(topo_id, as_conf, conf_key, def_num, nick, topo_key)
+            self._gen_srv_entry(topo_id, as_conf, conf_key, def_num, nick, topo_key, addr_type)
 
     def _gen_srv_entry(self, topo_id, as_conf, conf_key, def_num, nick,
-                       topo_key, uses_dispatcher=True):
-        addr_type = addr_type_from_underlay(as_conf.get('underlay', DEFAULT_UNDERLAY))
+                       topo_key, addr_type, uses_dispatcher=True):
         count = self._srv_count(as_conf, conf_key, def_num)
+        file_fmt = topo_id.file_fmt()
+        docker = self.args.docker
+        port_gen = self.args.port_gen
         for i in range(1, count + 1):
-            elem_id = "%s%s-%s" % (nick, topo_id.file_fmt(), i)
+            elem_id = "%s%s-%s" % (nick, file_fmt, i)
 
             port = self._default_ctrl_port(nick)
-            if not self.args.docker:
-                port = self.args.port_gen.register(elem_id)
+            if not docker:
+                port = port_gen.register(elem_id)
 
             d = {
                 'addr': join_host_port(self._reg_addr(topo_id, elem_id, addr_type).ip, port),
@@ -292,17 +310,14 @@ class TopoGenerator(object):
             count = 1
         return count
 
-    def _gen_br_entries(self, topo_id, as_conf):
-        addr_type = addr_type_from_underlay(as_conf.get('underlay', DEFAULT_UNDERLAY))
+    def _gen_br_entries(self, topo_id, addr_type):
         for (linkto, remote, attrs, l_br, r_br, l_ifid, r_ifid) in self.links[topo_id]:
             self._gen_br_entry(topo_id, l_ifid, remote, r_ifid,
                                linkto, attrs, l_br, r_br, addr_type)
 
     def _gen_br_entry(self, local, l_ifid, remote, r_ifid, remote_type, attrs,
                       local_br, remote_br, addr_type):
-        link_addr_type = addr_type_from_underlay(attrs.get('underlay', DEFAULT_UNDERLAY))
-        public_addr, remote_addr = self._reg_link_addrs(local_br, remote_br, l_ifid,
-                                                        r_ifid, link_addr_type)
+        public_addr, remote_addr = self.link_addrs[(local_br, remote_br, l_ifid, r_ifid)]
 
         intl_addr = self._reg_addr(local, local_br + "_internal", addr_type)
         if self.topo_dicts[local]["border_routers"].get(local_br) is None:
@@ -328,14 +343,13 @@ class TopoGenerator(object):
                 'remote': join_host_port(remote_addr.ip, SCION_ROUTER_PORT),
             },
             'isd_as': str(remote),
-            'link_to': LinkType.to_str(remote_type.lower()),
+            'link_to': link_type_to_str(remote_type),
             'mtu': attrs.get('mtu', self.args.default_mtu)
         }
 
     def _gen_sig_entries(self, topo_id, as_conf):
         addr_type = addr_type_from_underlay(DEFAULT_UNDERLAY)
-        elem_id = "sig" + topo_id.file_fmt()
-        reg_id = "sig" + topo_id.file_fmt()
+        elem_id = reg_id = "sig" + topo_id.file_fmt()
         port = 30256
         if not self.args.docker:
             port = self.args.port_gen.register(elem_id)
@@ -360,11 +374,11 @@ class TopoGenerator(object):
 
     def _write_as_list(self):
         list_path = os.path.join(self.args.output_dir, AS_LIST_FILE)
-        write_file(list_path, yaml.dump(dict(self.as_list)))
+        write_file(list_path, yaml.dump(dict(self.as_list), Dumper=SafeDumper))
 
     def _write_ifids(self):
         list_path = os.path.join(self.args.output_dir, IFIDS_FILE)
-        write_file(list_path, yaml.dump(self.ifid_map,
+        write_file(list_path, yaml.dump(dict(self.ifid_map), Dumper=SafeDumper,
                                         default_flow_style=False))
 
 
@@ -394,14 +408,22 @@ class IFIDGenerator(object):
 
     def __init__(self):
         self._ifids = set()
+        # Shuffled pool of candidate IFIDs, built on the first call to new().
+        self._free = None
 
     def new(self):
-        while True:
-            ifid = random.randrange(1, 4096)
+        if self._free is None:
+            self._free = [i for i in range(1, 4096) if i not in self._ifids]
+            random.shuffle(self._free)
+        while self._free:
+            ifid = self._free.pop()
+            # IFIDs passed to add() after the pool was built are skipped here.
             if ifid in self._ifids:
                 continue
             self.add(ifid)
             return ifid
+        logging.critical("No free IFIDs left!")
+        exit(1)
 
     def add(self, ifid):
         if ifid in self._ifids:
@@ -413,5 +435,11 @@ class IFIDGenerator(object):
         self._ifids.add(ifid)
 
 
+@lru_cache(maxsize=8)
 def addr_type_from_underlay(underlay: str) -> str:
     return underlay.split('/')[1]
+
+
+@lru_cache(maxsize=8)
+def link_type_to_str(link_type: str) -> str:
+    return LinkType.to_str(link_type.lower())